@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 '''
 Script to perform synchronous backup of an organization's github repos to a
@@ -10,22 +10,59 @@ ensure that the backup is up-to-date.
 '''
 
 import argparse
-import fcntl
+import asyncio
+import concurrent.futures
+import functools
 import json
 import logging
+import operator
 import os
-import subprocess
+import re
+import shutil
+import stat
 import sys
-import time
 import textwrap
+import time
+
+import urllib3
 
-import requests
+# orjson is optional, it decodes the (large) repo list pages several times
+# faster than the standard library.  Both accept the raw response bytes.
+try:
+    import orjson as _json
+except ImportError:
+    _json = json
+
+# uvloop is optional, its libuv event loop drains the git subprocess pipes
+# with less per-event overhead than the standard asyncio loop.
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 
 
 LOCAL_REPODIR = './repo_backups'
 TOKEN_FILE = '~/.ssh/github_api_token'
 ORG_NAME = 'mycompany'
+CACHE_DIR = '~/.cache/github_backup'
+JOBS = 8
+PER_PAGE = 100
+MAX_ATTEMPTS = 5
+SHALLOW_DEPTH = 50
+GC_INTERVAL = 7 * 24 * 60 * 60    # seconds
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+GRAPHQL_REPOS_QUERY = '''
+query($org: String!, $first: Int!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: $first, after: $cursor) {
+      pageInfo { endCursor hasNextPage }
+      nodes { name nameWithOwner pushedAt }
+    }
+  }
+}
+'''
 
 
 # Setup logging
@@ -111,6 +148,24 @@ class App(object):
             help='File containing GitHub oauth token (default is %s)' % TOKEN_FILE)
         paa('--local-repodir', default=LOCAL_REPODIR,
             help='Local repository container directory (default is %s)' % LOCAL_REPODIR)
+        paa('--cache-dir', default=CACHE_DIR,
+            help='Directory for cached github api responses (default is %s)' % CACHE_DIR)
+        paa('--jobs', type=int, default=JOBS,
+            help='Number of repos to backup in parallel (default is %d)' % JOBS)
+        paa('--shallow', action='store_true', default=False,
+            help='Clone new repos with only the last %d commits of history'
+                 % SHALLOW_DEPTH)
+        paa('--partial', action='store_true', default=False,
+            help='Clone new repos without trees or blobs (--filter=tree:0), '
+                 'much smaller but file contents are fetched from github on '
+                 'demand, so they cannot be read or searched while github is '
+                 'unreachable')
+        paa('--gc', action='store_true', default=False,
+            help='Run git maintenance (gc, commit-graph) on updated repos not '
+                 'maintained in the last %d days' % (GC_INTERVAL // 86400))
+        paa('--rest', action='store_true', default=False,
+            help='Get the repo list from the paginated REST api rather than '
+                 'the GraphQL api')
         paa('--dry-run', action='store_true', default=False,
             help='Run without actually updating local repos')
 
@@ -126,16 +181,37 @@ class App(object):
         self.org_name = args.org_name
         self.api_token = self._get_github_api_token(args.token_file)
         self.local_repodir = args.local_repodir
+        self.cache_dir = args.cache_dir
+        self.jobs = max(1, args.jobs)
+        self.shallow = args.shallow
+        self.partial = args.partial
+        self.gc = args.gc
+        self.rest = args.rest
         self.dry_run = args.dry_run
 
+        # One connection pool for all github api calls, reuses connections
+        # (keep-alive)
+        self.http = urllib3.PoolManager(maxsize=self.jobs)
+        self.api_headers = {
+            'Authorization': 'token %s' % self.api_token,
+            'Accept': 'application/vnd.github+json',
+            }
+        self.repos_url = "https://api.github.com/orgs/%s/repos" % (self.org_name)
+        self.repos_page_url = self.repos_url + "?per_page=%d&page=" % (PER_PAGE)
+
         if self.dry_run:
-            LOG.warn("dry-run mode, no changes will be made")
+            LOG.warning("dry-run mode, no changes will be made")
+
+        self.state = self._load_state()
 
-        repos_list = self._get_org_repos()
+        if self.rest:
+            repos_list = self._get_org_repos()
+        else:
+            repos_list = self._get_org_repos_graphql()
         self._run_backups(repos_list)
 
         if self.dry_run:
-            LOG.warn("dry-run mode, no changes were made")
+            LOG.warning("dry-run mode, no changes were made")
 
 
     def _get_org_repos(self):
@@ -144,41 +220,118 @@ class App(object):
         list-of-dict containing full information for all repos.
         '''
 
-        # Github api paginates query results, to get all pages, repeat query with
-        # incremented page number until empty results returned.
-
-        query_str = "https://api.github.com/orgs/%s/repos?per_page=100&page=%d"
-        page_number = 1
-        headers = {'authorization': 'token %s' % self.api_token}
-        repos_all = []
+        # Github api paginates query results.  The first response's Link header
+        # gives the last page number, so fetch the remaining pages in parallel
+        # over the pooled keep-alive connections.
 
         LOG.info("getting github repo list...")
+        self.etag_cache = self._load_etag_cache()
+
+        repos_page, last_page = self._get_repos_page(1)
+        repos_pages = [repos_page]
+
+        if last_page > 1:
+            workers = min(self.jobs, last_page - 1)
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            try:
+                results = executor.map(self._get_repos_page,
+                                       range(2, last_page + 1))
+                repos_pages += [repos_page for repos_page, _ in results]
+            finally:
+                executor.shutdown(wait=True)
+
+        # Pages that were unchanged (304) come back as None.  If every page is
+        # unchanged, reuse the previously concatenated list as-is.
+        page_urls = [self._repos_page_url(n) for n in range(1, last_page + 1)]
+        etags = [self.etag_cache.get(url, {}).get('etag') for url in page_urls]
+        etags_key = ' '.join(etags) if all(etags) else None
+        all_url = self._repos_page_url(None)
+        all_entry = self.etag_cache.get(all_url)
+
+        if (etags_key and all_entry and all_entry['etag'] == etags_key and
+                all(repos_page is None for repos_page in repos_pages)):
+            LOG.debug("repo list unchanged, using cache=%s" % (all_entry['path']))
+            repos_all = self._read_cache_file(all_entry['path'])
+
+        else:
+            # Page count is known up front, so allocate the list once and fill
+            # it in place, then trim any unused tail from a short last page.
+            repos_all = [None] * (last_page * PER_PAGE)
+            n_repos = 0
+            for url, repos_page in zip(page_urls, repos_pages):
+                if repos_page is None:
+                    repos_page = self._read_cache_file(self.etag_cache[url]['path'])
+                repos_all[n_repos:n_repos + len(repos_page)] = repos_page
+                n_repos += len(repos_page)
+            del repos_all[n_repos:]
+
+            if etags_key:
+                path = self._cache_path('%s_repos_all.json' % (self.org_name))
+                self._write_cache_file(path, json.dumps(repos_all).encode())
+                self.etag_cache[all_url] = {'etag': etags_key, 'path': path}
+
+        self._write_cache_file(self._cache_path('etags.json'),
+                               json.dumps(self.etag_cache).encode())
+
+        msg = "organization=%s, n_repos=%d" % (self.org_name, len(repos_all))
+        LOG.debug(msg)
+
+        return repos_all
+
+
+
+    def _get_org_repos_graphql(self):
+        '''
+        Gets a full list of an organization's repos from the github GraphQL
+        api, which returns 100 repos per request with only the fields used
+        here.  Returns a list-of-dict with the same keys as the REST api
+        (name, full_name, pushed_at).
+        '''
+        LOG.info("getting github repo list (graphql)...")
+
+        repos_all = []
+        cursor = None
         while True:
-            query_url = query_str % (self.org_name, page_number)
-            LOG.debug("request='%s'" % (query_url))
+            query = {'query': GRAPHQL_REPOS_QUERY,
+                     'variables': {'org': self.org_name, 'first': PER_PAGE,
+                                   'cursor': cursor}}
+            LOG.debug("request='%s', cursor=%s" % (GRAPHQL_URL, cursor))
             try:
-                req = requests.get(query_url, headers=headers)
-                response = req.content
-                status_code = req.status_code
-            except Exception, msg:
+                req = self._github_request(
+                    'POST', GRAPHQL_URL, body=json.dumps(query).encode(),
+                    headers={'Content-Type': 'application/json'})
+                status_code = req.status
+            except Exception as msg:
                 msg = "error getting repos list from github, query=%s, err=%s" % \
-                      (query_url, msg)
-                raise GBError, msg
-
-            repos_page = json.loads(response)
+                      (GRAPHQL_URL, msg)
+                raise GBError(msg)
 
             if status_code != 200:
                 msg = "error getting repos list from github, query=%s, " \
-                      "status=%s, reason=%s" % (query_url, status_code, req.reason)
-                raise GBError, msg
+                      "status=%s, reason=%s" % (GRAPHQL_URL, status_code, req.reason)
+                raise GBError(msg)
 
-            #TODO: repos_page should be a list of dict, if just a dict, there's an error.
-
-            if repos_page == []:
+            response = _json.loads(req.data)
+            if response.get('errors'):
+                msg = "error getting repos list from github, query=%s, " \
+                      "errors=%s" % (GRAPHQL_URL, response['errors'])
+                raise GBError(msg)
+
+            organization = (response.get('data') or {}).get('organization')
+            if organization is None:
+                msg = "organization=%s not found on github" % (self.org_name)
+                raise GBError(msg)
+
+            repositories = organization['repositories']
+            repos_all += [{'name': node['name'],
+                           'full_name': node['nameWithOwner'],
+                           'pushed_at': node['pushedAt']}
+                          for node in repositories['nodes']]
+
+            page_info = repositories['pageInfo']
+            if not page_info['hasNextPage']:
                 break
-
-            repos_all += repos_page
-            page_number += 1
+            cursor = page_info['endCursor']
 
         msg = "organization=%s, n_repos=%d" % (self.org_name, len(repos_all))
         LOG.debug(msg)
@@ -187,200 +340,525 @@ class App(object):
 
 
 
+    def _repos_page_url(self, page_number):
+        '''
+        Returns the github api url for one page of an organization's repos, or
+        for the whole (unpaginated) listing if page_number is None.
+        '''
+        if page_number is None:
+            return self.repos_url
+        return self.repos_page_url + str(page_number)
+
+
+
+    def _get_repos_page(self, page_number):
+        '''
+        Gets one page of an organization's repos from github, returns a
+        (list-of-dict, last_page_number) tuple.  Sends the page's cached ETag
+        so github can answer 304 if nothing changed, in which case the
+        list-of-dict is None and the caller should read the cached page.
+        '''
+        query_url = self._repos_page_url(page_number)
+        LOG.debug("request='%s'" % (query_url))
+
+        headers = {}
+        cache_entry = self.etag_cache.get(query_url)
+        if cache_entry and os.path.exists(cache_entry['path']):
+            headers['If-None-Match'] = cache_entry['etag']
+
+        try:
+            req = self._github_request('GET', query_url, headers=headers)
+            response = req.data
+            status_code = req.status
+        except Exception as msg:
+            msg = "error getting repos list from github, query=%s, err=%s" % \
+                  (query_url, msg)
+            raise GBError(msg)
+
+        if status_code not in (200, 304):
+            msg = "error getting repos list from github, query=%s, " \
+                  "status=%s, reason=%s" % (query_url, status_code, req.reason)
+            raise GBError(msg)
+
+        # Other pages may have changed even when this one has not, so prefer
+        # the response's Link header over the cached page count.
+        last_page = page_number
+        if status_code == 304:
+            last_page = max(last_page, cache_entry['last_page'])
+        match = re.search(r'<[^>]*[?&]page=(\d+)[^>]*>;\s*rel="last"',
+                          req.headers.get('Link', ''))
+        if match:
+            last_page = int(match.group(1))
+
+        if status_code == 304:
+            cache_entry['last_page'] = last_page
+            return (None, last_page)
+
+        repos_page = _json.loads(response)
+
+        #TODO: repos_page should be a list of dict, if just a dict, there's an error.
+
+        etag = req.headers.get('ETag')
+        if etag:
+            path = self._cache_path('%s_repos_page_%d.json' %
+                                    (self.org_name, page_number))
+            self._write_cache_file(path, response)
+            self.etag_cache[query_url] = {
+                'etag': etag, 'path': path, 'last_page': last_page}
+        else:
+            self.etag_cache.pop(query_url, None)
+
+        return (repos_page, last_page)
+
+
+
+    def _github_request(self, method, url, headers=None, **kwargs):
+        '''
+        Sends a github api request on the pool, returns the response.  Waits
+        out rate limiting (until X-RateLimit-Reset) and backs off exponentially
+        on server errors or Retry-After, giving up after MAX_ATTEMPTS and
+        returning the last response for the caller to report.
+        '''
+        req_headers = dict(self.api_headers, **(headers or {}))
+
+        for attempt in range(MAX_ATTEMPTS):
+            req = self.http.request(method, url, headers=req_headers, **kwargs)
+            status_code = req.status
+            headers = req.headers
+
+            if attempt == MAX_ATTEMPTS - 1:
+                break
+
+            if (status_code in (403, 429) and
+                    headers.get('X-RateLimit-Remaining') == '0' and
+                    'X-RateLimit-Reset' in headers):
+                delay = max(0, int(headers['X-RateLimit-Reset']) - time.time()) + 1
+            elif status_code >= 500 or (status_code >= 400 and
+                                        'Retry-After' in headers):
+                delay = 2 ** attempt
+                if headers.get('Retry-After', '').isdigit():
+                    delay = max(delay, int(headers['Retry-After']))
+            else:
+                break
+
+            LOG.warning("github api status=%s, retrying in %ds, query=%s" %
+                        (status_code, delay, url))
+            time.sleep(delay)
+
+        return req
+
+
+
+    def _cache_path(self, filename):
+        '''
+        Returns the path of filename in the cache directory, creating the
+        directory (owner-access-only) if needed.
+        '''
+        cache_dir = os.path.expanduser(self.cache_dir)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir, 0o700)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+        return os.path.join(cache_dir, filename)
+
+
+
+    def _load_etag_cache(self):
+        '''
+        Loads the {url: {'etag', 'path', ...}} cache of github api responses
+        from a previous run, returns an empty cache if missing or unreadable.
+        '''
+        try:
+            return self._read_cache_file(self._cache_path('etags.json'))
+        except (IOError, ValueError) as err:
+            LOG.debug("no usable etag cache, err=%s" % (err))
+            return {}
+
+
+
+    def _read_cache_file(self, path):
+        '''
+        Reads and returns the json contents of a cache file
+        '''
+        with open(path, 'rb') as cf:
+            return _json.loads(cf.read())
+
+
+
+    def _write_cache_file(self, path, data):
+        '''
+        Atomically replaces a cache file with data, so an interrupted run never
+        leaves a partially written file behind.
+        '''
+        tmp_path = "%s.tmp.%d" % (path, os.getpid())
+        with open(tmp_path, 'wb') as cf:
+            cf.write(data)
+        os.rename(tmp_path, path)
+
+
+
     def _run_backups(self, repos_list):
         '''
         Processes each repo in the list received from github. Runs a 'git clone'
-        if the local repo does not exist, otherwise runs a 'git pull' for each
-        branch in the local repo.
+        if the local repo does not exist, otherwise runs a 'git fetch' of all
+        branches and tags into the local repo.  Repos whose github pushed_at is
+        unchanged since the last successful backup are skipped.
         '''
 
         local_repodir = os.path.abspath(self.local_repodir)
         if not os.path.isdir(local_repodir):
             try:
                 os.makedirs(local_repodir)
-            except Exception, err:
+            except Exception as err:
                 msg = "cannot create local_repodir=%s, %s" % (local_repodir, err)
-                raise IOError, msg
+                raise IOError(msg)
 
-        for repo in sorted(repos_list):
+        # One directory read instead of a stat per repo
+        existing = {e.name for e in os.scandir(local_repodir) if e.is_dir()}
 
-            repo_name = repo['name']
+        new_state = {}
+        to_backup = []
+        n_skipped = 0
+        for repo in sorted(repos_list, key=operator.itemgetter('full_name')):
             full_name = repo['full_name']
+            pushed_at = repo.get('pushed_at')
+            entry = self._state_entry(full_name)
+            if (pushed_at and entry.get('pushed_at') == pushed_at and
+                    repo['name'] in existing):
+                LOG.debug("unchanged since last backup, skipping repo=%s" %
+                          (full_name))
+                new_state[full_name] = entry
+                n_skipped += 1
+                continue
+            to_backup.append(repo)
+
+        # Repo updates are dominated by waiting on the remote git server, so
+        # run up to self.jobs git subprocesses at once from one event loop.
+        results = self._run_async(
+            self._backup_all(to_backup, local_repodir, existing))
+
+        now = time.time()
+        gc_due = []
+        n_errors = 0
+        for repo, (repo_name, ok, err) in zip(to_backup, results):
+            if ok:
+                full_name = repo['full_name']
+                entry = dict(self._state_entry(full_name),
+                             pushed_at=repo.get('pushed_at'))
+                if repo['name'] not in existing:
+                    entry['last_gc'] = now    # Fresh clone, already one pack
+                new_state[full_name] = entry
+                if self.gc and now - entry.get('last_gc', 0) > GC_INTERVAL:
+                    gc_due.append(repo)
+            else:
+                n_errors += 1
 
-            msg = ("considering remote repo %s, full_name=%s",
-                   (repo_name, full_name))
-            LOG.info(msg)
+        # Repack only repos that were just fetched and have not been gc'd
+        # recently, after all fetches are done, at lowest cpu & io priority.
+        if gc_due:
+            results = self._run_async(self._maintain_all(gc_due, local_repodir))
+            for repo, ok in zip(gc_due, results):
+                if ok:
+                    new_state[repo['full_name']]['last_gc'] = now
 
-            ## Shell command to perform a 'git pull' on all branches of a repo
-            #pab_cmd = '''\
-            #git remote update; \
-            #for b in `git branch -r | grep -v 'HEAD' | sed -e 's#origin/##'`; do \
-            #echo pulling repo=%s branch=$b; git checkout $b && git pull; done \
-            #'''
-            #pab_cmd = textwrap.dedent(pab_cmd) % (repo_name)
+        if not self.dry_run:
+            self._save_state(new_state)
 
-            repo_path = local_repodir + "/" + repo_name
-            try:
-                if not os.path.exists(repo_path):
-                    self._clone_repo_local(repo_path, full_name)
-                else:
-                    self._pull_all_branches(repo_name, repo_path)
+        msg = "n_repos=%d, n_skipped=%d, n_errors=%d, n_gc=%d" % \
+              (len(repos_list), n_skipped, n_errors, len(gc_due))
+        LOG.info(msg)
 
-            except KeyboardInterrupt:
-                raise IOError, "CTRL-C received, aborting"
 
-            except Exception, err:
-                msg = "error updating repo=%s, err=%s" % (repo_name, err)
+
+    def _run_async(self, coro):
+        '''
+        Runs coroutine coro to completion in a new event loop (uvloop if
+        available), returns its result.
+        '''
+        # The event loop policy works with every uvloop version, uvloop.run()
+        # only exists in 0.18+ (Ubuntu 22.04 and Debian 12 ship older ones).
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        try:
+            return asyncio.run(coro)
+        except KeyboardInterrupt:
+            raise IOError("CTRL-C received, aborting")
+
+
+
+    def _state_path(self):
+        '''
+        Returns the path of the file holding {full_name: {'pushed_at',
+        'last_gc'}} for every repo successfully backed up by the previous run.
+        '''
+        return self._cache_path('%s_state.json' % (self.org_name))
+
+
+
+    def _state_entry(self, full_name):
+        '''
+        Returns a copy of the previous run's state for a repo, an empty dict if
+        there is none (or it is in an older format).
+        '''
+        entry = self.state.get(full_name)
+        return dict(entry) if isinstance(entry, dict) else {}
+
+
+
+    def _load_state(self):
+        '''
+        Loads the backup state from the previous run, returns an empty state if
+        missing or unreadable (i.e. every repo gets updated).
+        '''
+        try:
+            return self._read_cache_file(self._state_path())
+        except (IOError, ValueError) as err:
+            LOG.debug("no usable backup state, err=%s" % (err))
+            return {}
+
+
+
+    def _save_state(self, state):
+        '''
+        Atomically replaces the backup state file for the next run
+        '''
+        self._write_cache_file(self._state_path(), json.dumps(state).encode())
+
+
+
+    async def _backup_all(self, repos_list, local_repodir, existing):
+        '''
+        Backs up every repo in repos_list, at most self.jobs at a time.
+        existing is the set of repo names already present in local_repodir.
+        Returns a list of (repo_name, ok, err) tuples in repos_list order.
+        '''
+        sem = asyncio.Semaphore(self.jobs)
+        return await asyncio.gather(
+            *[self._backup_one(repo, local_repodir, repo['name'] in existing, sem)
+              for repo in repos_list])
+
+
+
+    async def _maintain_all(self, repos_list, local_repodir):
+        '''
+        Runs git maintenance on every repo in repos_list, at most self.jobs at
+        a time.  Returns a list of ok booleans in repos_list order.
+        '''
+        sem = asyncio.Semaphore(self.jobs)
+        return await asyncio.gather(
+            *[self._maintain_one(os.path.join(local_repodir, repo['name']), sem)
+              for repo in repos_list])
+
+
+
+    async def _maintain_one(self, repo_path, sem):
+        '''
+        Repacks a local repo and updates its commit-graph, keeps fetches fast
+        as packfiles accumulate.  Errors are logged rather than raised.
+        Returns True on success.
+        '''
+        cmd = ["nice", "-n", "19"]
+        if shutil.which("ionice"):
+            cmd += ["ionice", "-c3"]
+        cmd += ["git", "-C", repo_path, "maintenance", "run",
+                "--task=gc", "--task=commit-graph"]
+
+        async with sem:
+            LOG.info("maintaining local_repo=%s" % (repo_path))
+            try:
+                await self._run_system_cmd_nb(cmd)
+            except Exception as err:
+                msg = "error maintaining repo=%s, err=%s" % (repo_path, err)
                 LOG.error(msg)
-                # Allow main loop to continue
+                return False
+
+        return True
 
 
 
-    def _clone_repo_local(self, repo_path, full_name):
+    async def _backup_one(self, repo, local_repodir, exists, sem):
         '''
-        Performs a 'git clone' of GitHub repo to local repo
+        Backs up a single repo, runs a 'git clone --bare' if the local repo
+        does not exist, otherwise a 'git fetch' of all refs.  Errors are logged
+        rather than raised, so the remaining repos continue.  Returns a
+        (repo_name, ok, err) tuple.
         '''
-        LOG.info("creating local_repo=%s" % (repo_path))
-        local_repodir = os.path.basename(repo_path)
-        os.chdir(local_repodir)  # Go (back) to container directory
-        LOG.info("current_directory=%s" % (os.getcwd()))
-        cmd = "git clone git@github.com:%s.git" % (full_name)
-        self._run_system_cmd_nb(cmd)
-        os.chdir(repo_path)    # Get into repo directory
+        repo_name = repo['name']
+        full_name = repo['full_name']
+
+        async with sem:
+            msg = "considering remote repo %s, full_name=%s" % (repo_name, full_name)
+            LOG.info(msg)
+
+            repo_path = os.path.join(local_repodir, repo_name)
+            try:
+                if not exists:
+                    await self._clone_repo_local(repo_path, full_name)
+                else:
+                    await self._pull_all_branches(repo_name, repo_path)
+
+            except Exception as err:
+                msg = "error updating repo=%s, err=%s" % (repo_name, err)
+                LOG.error(msg)
+                return (repo_name, False, err)
+
+        return (repo_name, True, None)
 
 
 
-    def _pull_all_branches(self, repo_name, repo_path):
+    async def _clone_repo_local(self, repo_path, full_name):
         '''
-        Performs a 'git pull' on all branches of a Github repo
+        Performs a 'git clone --bare' of GitHub repo to local repo.  A bare repo
+        has no working tree, branches and tags are updated by fetch.
         '''
-        LOG.info("updating local_repo=%s, all branches" % (repo_path))
-        os.chdir(repo_path)
-        LOG.info("current_directory=%s" % (os.getcwd()))
+        LOG.info("creating local_repo=%s" % (repo_path))
 
-        gab_cmd = 'git branch -r'
-        all_branches = self._run_system_cmd_nb(gab_cmd, stdoutctl='return')
+        # Auto gc and reflogs are disabled so fetches stay cheap, repacking is
+        # left to the scheduled --gc maintenance.
+        cmd = ["git", "clone", "--bare",
+               "--config", "gc.auto=0",
+               "--config", "core.logAllRefUpdates=false"]
+        if self.partial:
+            cmd += ["--filter=tree:0"]
+        if self.shallow:
+            cmd += ["--depth=%d" % (SHALLOW_DEPTH), "--no-single-branch"]
+        cmd += ["git@github.com:%s.git" % (full_name), repo_path]
 
-        for curr_branch in all_branches:
-            cbranch = curr_branch[len('  origin'):]    # Remove prefix
-            if 'origin/HEAD' in cbranch:               # Skip HEAD branch entry
-                continue
-            LOG.info("updating repo=%s, branch=%s" % (repo_name, curr_branch))
-            gcb_cmd = "git branch %s && git pull" % (curr_branch)
-            self._run_system_cmd_nb(gcb_cmd)
+        await self._run_system_cmd_nb(cmd, cwd=os.path.dirname(repo_path))
 
 
 
-    def _run_system_cmd(self, cmd):
+    async def _pull_all_branches(self, repo_name, repo_path):
         '''
-        Runs a system command while logging the command
+        Updates all branches and tags of a Github repo.  This is a backup, with
+        no local work, so a single fetch of every ref replaces checking out and
+        pulling each branch in turn.  In bare repos, branches and tags are
+        fetched straight into the local refs (github's pull request refs are
+        not).  Older backups are ordinary clones with a checked-out branch,
+        which git refuses to fetch into, so those update their remote-tracking
+        branches instead.
         '''
-        if not self.dry_run:
-            LOG.info("running cmd: %s" % (cmd))
-            os.system(cmd)
-        return
+        LOG.info("updating local_repo=%s, all branches" % (repo_path))
 
+        cmd = ["git", "-C", repo_path, "rev-parse", "--is-bare-repository"]
+        is_bare = await self._run_system_cmd_nb(cmd, stdoutctl='return')
 
+        if is_bare == ['true']:
+            cmd = ["git", "-C", repo_path, "fetch", "--prune", "--prune-tags",
+                   "origin", "+refs/heads/*:refs/heads/*",
+                   "+refs/tags/*:refs/tags/*"]
+        else:
+            cmd = ["git", "-C", repo_path, "fetch", "--all", "--prune", "--tags"]
+        await self._run_system_cmd_nb(cmd)
 
-    def _run_system_cmd_nb(self, cmd, stdoutctl='log'):
+
+
+    async def _run_system_cmd_nb(self, cmd, stdoutctl='log', cwd=None):
         '''
-        Runs a non-blocking system command via subprocess module, asynchronously
-        captures all stdout & stderr output text lines, and prints output to
-        log, or returns output to calling function.
+        Runs a non-blocking system command as an asyncio subprocess, captures
+        all stdout & stderr output text lines as they appear, and prints output
+        to log, or returns output to calling function.  Raises GBError if the
+        command fails.
 
         Arguments:
             cmd - Command string or list. If single string then subprocess is
                   run with shell=True.  If list, then shell=False.
             stdoutctl - What to do with stdout, 'log' => log.info, 'return' =>
                         return list of output text lines to calling function.
+            cwd - Directory to run the command in, default is the current
+                  directory.  Never chdir, commands may run in parallel.
         '''
-        LOG.info("running cmd: %s" % (cmd))
+        LOG.info("running cmd: %s, cwd=%s" % (cmd, cwd))
 
         if self.dry_run:
             return
 
-        # Non-blocking subprocess I/O method, adapted from:
-        # stackoverflow.com/questions/8980050/persistent-python-subprocess
+        pipes = dict(cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                     stderr=asyncio.subprocess.PIPE)
+        if isinstance(cmd, str):
+            proc = await asyncio.create_subprocess_shell(cmd, **pipes)
+        else:
+            proc = await asyncio.create_subprocess_exec(*cmd, **pipes)
 
-        proc = subprocess.Popen(
-            cmd,
-            #shell = True if isinstance(cmd, str) else False,
-            shell = True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            )
+        rtn_lines = []
+        out_handler = rtn_lines.append if stdoutctl == 'return' else LOG.info
 
-        # Set output pipes to be nonblocking
-        fcntl.fcntl(proc.stdout.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
-        fcntl.fcntl(proc.stderr.fileno(), fcntl.F_SETFL, os.O_NONBLOCK)
+        await asyncio.gather(
+            self._drain(proc.stdout, out_handler),
+            self._drain(proc.stderr, LOG.error),
+            proc.wait())
 
-        rtn_lines = []
+        LOG.debug("proc.returncode=%d" % (proc.returncode))
 
-        # Simple polling loop to print cmd's stdout/stderr output as it appears
-        while proc.poll() is None:
-            try:
-                output = proc.stdout.readline().rstrip()
-            except IOError:
-                pass    # No data to read, skip
-            else:
-                if stdoutctl == 'return':
-                    rtn_lines.append(output)
-                else:
-                    LOG.info(output)
+        if proc.returncode != 0:
+            msg = "cmd failed, cmd=%s, returncode=%d" % (cmd, proc.returncode)
+            raise GBError(msg)
 
-            try:
-                errout = proc.stderr.readline().rstrip()
-            except IOError:
-                pass    # No data to read, skip
-            else:
-                LOG.error(errout)
+        return None if stdoutctl == 'log' else rtn_lines
 
-            time.sleep(0.01)
 
-        LOG.debug("proc.returncode=%d" % (proc.returncode))
 
-        return None if stdoutctl == 'log' else rtn_lines
+    async def _drain(self, stream, handler):
+        '''
+        Passes each output line of an asyncio subprocess stream to handler as
+        soon as it is complete, until EOF.
+        '''
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            handler(line.rstrip().decode('utf-8', 'replace'))
 
 
 
-    def _get_github_api_token(self, github_token_file):
+    @staticmethod
+    @functools.lru_cache(maxsize=4)
+    def _get_github_api_token(github_token_file):
         '''
         Reads github (oauth) api token from the github_token_file. Also enforces
         best security practices by requiring the proper permissions for the
         token file (same as ssh key rules).  If any problem prevents reading
-        the key, will raise an IOError exception.
+        the key, will raise an IOError exception.  The token is cached, so the
+        file is only read once per process.
         '''
         token_file = os.path.expanduser(github_token_file)
 
-        # Verify file exists
-        if not os.path.exists(token_file):
+        # Verify file exists, keep its stat for the permissions check below
+        try:
+            token_stat = os.stat(token_file, follow_symlinks=False)
+        except FileNotFoundError:
             msg = "missing file %s, cannot proceed" % (token_file)
-            raise IOError, msg
+            raise IOError(msg)
+
+        # Refuse a symlink, the permissions checked below would be the link's
+        if stat.S_ISLNK(token_stat.st_mode):
+            msg = "file %s is a symlink, must be a regular file" % (token_file)
+            raise IOError(msg)
 
         # Check permissions on the parent directory
         token_parent_dir = os.path.dirname(token_file)
-        perms = os.stat(token_parent_dir).st_mode & 0777
-        if perms & 0077 != 0:
+        perms = os.stat(token_parent_dir).st_mode & 0o777
+        if perms & 0o077 != 0:
             msg = "bad permissions mode (%o) on directory %s, must be " \
                   "owner-access-only (e.g. 0700)" % (perms, token_parent_dir)
-            raise IOError, msg
+            raise IOError(msg)
 
         # Check permissions on the file itself
-        perms = os.stat(token_file).st_mode & 0777
-        if perms & 0077 != 0:
+        perms = token_stat.st_mode & 0o777
+        if perms & 0o077 != 0:
             msg = "bad permissions mode (%o) on file %s, must be " \
                   "owner-access-only (e.g. 0400)" % (perms, token_file)
-            raise IOError, msg
+            raise IOError(msg)
 
         # Read file contents as the api token
         try:
-            tf = open(token_file)
-            github_api_token = tf.read().rstrip()
-        except Exception, err:
+            with open(token_file, 'rb') as tf:
+                github_api_token = tf.read().rstrip().decode()
+        except Exception as err:
             msg = "cannot read value from %s, err=%s" % (token_file, err)
-            raise IOError, msg
-        finally:
-            tf.close()
+            raise IOError(msg)
 
         return github_api_token
 
@@ -392,7 +870,7 @@ class App(object):
         '''
         try:
             self.run()
-        except (IOError, GBError), err:
+        except (IOError, GBError) as err:
             msg = "github_backup_repos: %s" % err
             LOG.error(msg)
             sys.exit(1)